@@ -1,6 +1,6 @@
 from flask import Flask, request, jsonify, send_file, after_this_request
 from flask_cors import CORS
-import requests
+import httpx
 import io
 import zipfile
 import os
@@ -9,11 +9,14 @@ import gc
 from PIL import Image
 from pptx import Presentation
 from pptx.util import Inches
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
+import fitz
 import logging
 import threading
 import time
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -22,115 +25,293 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
-# Global list to track temporary files and buffers for cleanup
-cleanup_queue = []
-cleanup_lock = threading.Lock()
+# Number of images fetched concurrently per conversion
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '16'))
+# Max downloads in flight or waiting to be consumed, bounds memory per conversion
+DOWNLOAD_QUEUE_DEPTH = int(os.environ.get('DOWNLOAD_QUEUE_DEPTH', str(DOWNLOAD_WORKERS * 2)))
 
-def cleanup_resources():
-    """Background cleanup of temporary resources"""
-    while True:
+# Processes used for JPEG re-encoding, created on first use. Each Gunicorn worker
+# gets its own pool, so by default split the CPUs across WORKERS (see gunicorn_conf.py)
+_cpu_count = os.cpu_count() or 1
+ENCODE_WORKERS = int(os.environ.get(
+    'ENCODE_WORKERS',
+    str(max(1, _cpu_count // int(os.environ.get('WORKERS', str(_cpu_count)))))
+))
+encode_pool = None
+encode_pool_lock = threading.Lock()
+
+# Shared HTTP/2 client so downloads from the same image host are multiplexed over one connection
+_limits = httpx.Limits(max_connections=max(32, DOWNLOAD_WORKERS), max_keepalive_connections=16)
+CLIENT = httpx.Client(
+    headers={
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    },
+    timeout=30,
+    follow_redirects=True,
+    transport=httpx.HTTPTransport(http2=True, limits=_limits, retries=3)
+)
+
+# httpx only retries failed connects, so transient HTTP errors are retried in download_image
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# HEAD responses that mean an image URL is definitely dead
+DEAD_URL_STATUS_CODES = {404, 410}
+DOWNLOAD_RETRIES = 3
+RETRY_BACKOFF = 0.5
+MAX_RETRY_DELAY = 10
+
+# Bounded LRU cache of raw image bytes keyed by URL, capped by entry count and total bytes
+IMAGE_CACHE_SIZE = int(os.environ.get('IMAGE_CACHE_SIZE', '128'))
+IMAGE_CACHE_BYTES = int(os.environ.get('IMAGE_CACHE_BYTES', str(64 * 1024 * 1024)))
+# Bodies larger than this are never cached
+IMAGE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_ENTRY_BYTES', str(4 * 1024 * 1024)))
+image_cache = OrderedDict()
+image_cache_bytes = 0
+image_cache_lock = threading.Lock()
+
+# Reject decompression bombs and oversized downloads before they exhaust memory
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', '25000000'))
+MAX_DOWNLOAD_BYTES = int(os.environ.get('MAX_DOWNLOAD_BYTES', str(50 * 1024 * 1024)))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# JPEG quality for images re-encoded into ZIP downloads
+ZIP_JPEG_QUALITY = 95
+
+# Image formats python-pptx can embed without re-encoding
+PPTX_IMAGE_FORMATS = {'JPEG', 'PNG', 'GIF', 'BMP'}
+
+# Image formats PyMuPDF can embed without re-encoding
+PDF_IMAGE_FORMATS = {'JPEG', 'PNG', 'GIF', 'BMP', 'TIFF'}
+
+def get_cached_image(url):
+    """Return cached image bytes for URL, or None"""
+    with image_cache_lock:
+        content = image_cache.get(url)
+        if content is not None:
+            image_cache.move_to_end(url)
+        return content
+
+def encode_jpeg(image_data, quality=75):
+    """Re-encode image bytes as JPEG bytes, flattening transparency onto white"""
+    image = Image.open(io.BytesIO(image_data))
+    if image.mode == 'P' and 'transparency' in image.info:
+        image = image.convert('RGBA')
+    if image.mode in ('RGBA', 'LA'):
+        # Convert RGBA to RGB
+        rgb_image = Image.new('RGB', image.size, (255, 255, 255))
+        rgb_image.paste(image, mask=image.split()[-1])
+        image = rgb_image
+    elif image.mode not in ('RGB', 'L', 'CMYK'):
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+def get_encode_pool():
+    """Return the shared process pool for JPEG encoding"""
+    global encode_pool
+    with encode_pool_lock:
+        if encode_pool is None:
+            # spawn avoids forking a process that is running download threads
+            encode_pool = ProcessPoolExecutor(
+                max_workers=ENCODE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return encode_pool
+
+def reset_encode_pool(pool):
+    """Discard a broken encode pool so the next call to get_encode_pool starts a fresh one"""
+    global encode_pool
+    with encode_pool_lock:
+        if encode_pool is pool:
+            encode_pool = None
+    # No cancel_futures: the broken pool fails its own pending work, which
+    # encode_result re-encodes in-thread for whichever request owns it
+    pool.shutdown(wait=False)
+
+def submit_encode(image_data, quality):
+    """Submit a JPEG re-encode to the process pool, falling back to encoding in-thread"""
+    for _ in range(2):
+        pool = get_encode_pool()
         try:
-            with cleanup_lock:
-                current_time = time.time()
-                items_to_remove = []
-                
-                for item in cleanup_queue:
-                    # Clean up items older than 5 minutes
-                    if current_time - item['created'] > 300:
-                        try:
-                            if item['type'] == 'file' and os.path.exists(item['path']):
-                                os.unlink(item['path'])
-                                logger.info(f"Cleaned up temporary file: {item['path']}")
-                            elif item['type'] == 'buffer':
-                                if hasattr(item['buffer'], 'close'):
-                                    item['buffer'].close()
-                                logger.info("Cleaned up buffer")
-                        except Exception as e:
-                            logger.error(f"Error cleaning up {item['type']}: {e}")
-                        finally:
-                            items_to_remove.append(item)
-                
-                # Remove cleaned items from queue
-                for item in items_to_remove:
-                    cleanup_queue.remove(item)
-            
-            # Force garbage collection
-            if items_to_remove:
-                gc.collect()
-                
-            time.sleep(60)  # Check every minute
-            
-        except Exception as e:
-            logger.error(f"Cleanup thread error: {e}")
-            time.sleep(60)
-
-# Start cleanup thread
-cleanup_thread = threading.Thread(target=cleanup_resources, daemon=True)
-cleanup_thread.start()
-
-def schedule_cleanup(resource_type, path=None, buffer=None):
-    """Schedule a resource for cleanup"""
-    with cleanup_lock:
-        cleanup_queue.append({
-            'type': resource_type,
-            'path': path,
-            'buffer': buffer,
-            'created': time.time()
-        })
+            return pool.submit(encode_jpeg, image_data, quality)
+        except BrokenProcessPool:
+            logger.warning("Encode pool is broken, starting a new one")
+            reset_encode_pool(pool)
+    
+    # Pool keeps failing, encode here so the slide is not dropped
+    future = Future()
+    try:
+        future.set_result(encode_jpeg(image_data, quality))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def encode_result(future, image_data, quality):
+    """Return the result of a pooled encode, re-encoding in-thread if its worker died"""
+    try:
+        return future.result()
+    except (BrokenProcessPool, CancelledError):
+        # The pool itself is replaced on the next submit_encode
+        logger.warning("Encode worker died, re-encoding in-thread")
+        return encode_jpeg(image_data, quality)
+
+def cache_image(url, content):
+    """Store image bytes for URL, evicting least recently used entries to stay within budget"""
+    global image_cache_bytes
+    if IMAGE_CACHE_SIZE <= 0 or len(content) > min(IMAGE_CACHE_MAX_ENTRY_BYTES, IMAGE_CACHE_BYTES):
+        return
+    with image_cache_lock:
+        previous = image_cache.pop(url, None)
+        if previous is not None:
+            image_cache_bytes -= len(previous)
+        image_cache[url] = content
+        image_cache_bytes += len(content)
+        while len(image_cache) > IMAGE_CACHE_SIZE or image_cache_bytes > IMAGE_CACHE_BYTES:
+            _, evicted = image_cache.popitem(last=False)
+            image_cache_bytes -= len(evicted)
+
+def read_response_body(response):
+    """Read a streamed response body, enforcing MAX_DOWNLOAD_BYTES as it arrives"""
+    body = io.BytesIO()
+    for chunk in response.iter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+        body.write(chunk)
+        if body.tell() > MAX_DOWNLOAD_BYTES:
+            raise ValueError(f"Image too large: more than {MAX_DOWNLOAD_BYTES} bytes")
+    # getvalue() hands back the internal buffer without another copy
+    return body.getvalue()
+
+def retry_delay(response, attempt):
+    """Seconds to wait before retrying a transient HTTP error, honouring Retry-After"""
+    retry_after = response.headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        return min(int(retry_after), MAX_RETRY_DELAY)
+    return min(RETRY_BACKOFF * (2 ** attempt), MAX_RETRY_DELAY)
 
 def download_image(url):
     """Download image from URL and return PIL Image object"""
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
+        content = get_cached_image(url)
+        cached = content is not None
+        if not cached:
+            for attempt in range(DOWNLOAD_RETRIES + 1):
+                with CLIENT.stream('GET', url) as response:
+                    if response.status_code in RETRY_STATUS_CODES and attempt < DOWNLOAD_RETRIES:
+                        delay = retry_delay(response, attempt)
+                        logger.warning(f"HTTP {response.status_code} for {url}, retrying in {delay}s")
+                    else:
+                        response.raise_for_status()
+                        content_length = int(response.headers.get('Content-Length') or 0)
+                        if content_length > MAX_DOWNLOAD_BYTES:
+                            raise ValueError(f"Image too large: {content_length} bytes")
+                        content = read_response_body(response)
+                        break
+                time.sleep(delay)
         
         # Convert to PIL Image
-        image = Image.open(io.BytesIO(response.content))
-        return image, response.content
+        image = Image.open(io.BytesIO(content))
+        if image.width * image.height > MAX_IMAGE_PIXELS:
+            raise Image.DecompressionBombError(
+                f"Image size ({image.width * image.height} pixels) exceeds limit of {MAX_IMAGE_PIXELS} pixels"
+            )
+        if not cached:
+            cache_image(url, content)
+        return image, content
     except Exception as e:
         logger.error(f"Failed to download image {url}: {str(e)}")
         raise
 
+def _download_or_none(url):
+    """Download image, returning None instead of raising on failure"""
+    try:
+        return download_image(url)
+    except Exception:
+        return None
+
+def download_images(urls):
+    """Download images concurrently, yielding results in input order (None on failure)"""
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        pending = deque()
+        for url in urls:
+            # Hand finished downloads to the caller while later ones keep fetching
+            if len(pending) >= max(1, DOWNLOAD_QUEUE_DEPTH):
+                yield pending.popleft().result()
+            pending.append(executor.submit(_download_or_none, url))
+        while pending:
+            yield pending.popleft().result()
+
+def check_image_url(url):
+    """HEAD an image URL and return (status, error) if it definitely cannot be used, else None"""
+    if get_cached_image(url) is not None:
+        return None
+    try:
+        response = CLIENT.head(url, timeout=5)
+    except Exception:
+        # Timeouts and connection errors may be transient, let the real download decide
+        return None
+    if response.status_code in DEAD_URL_STATUS_CODES:
+        # Upstream says the image is gone, the client's request itself was valid
+        return 502, f"HTTP {response.status_code}"
+    if not response.is_success:
+        # 405/501 (no HEAD support), 429 and 5xx are left to the download and its retries
+        return None
+    content_length = int(response.headers.get('Content-Length') or 0)
+    if content_length > MAX_DOWNLOAD_BYTES:
+        return 400, f"Image too large: {content_length} bytes"
+    return None
+
+def find_bad_image_url(urls):
+    """Screen URLs with parallel HEAD requests, returning the first (url, status, error) found or None"""
+    unique_urls = list(dict.fromkeys(urls))
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        for url, problem in zip(unique_urls, executor.map(check_image_url, unique_urls)):
+            if problem:
+                status, error = problem
+                return url, status, error
+    return None
+
+def create_output_file():
+    """Return a temporary file for conversion output, deleted when closed"""
+    # Disk-backed so large decks don't sit on the heap, and can be served with sendfile()
+    return tempfile.NamedTemporaryFile()
+
 def create_pdf_from_images(images, title):
     """Create PDF from list of image URLs"""
-    pdf_buffer = io.BytesIO()
+    pdf_buffer = create_output_file()
     
     try:
-        # Download first image to get dimensions
-        first_image, _ = download_image(images[0])
-        width, height = first_image.size
-        
-        # Create PDF with custom page size
-        c = canvas.Canvas(pdf_buffer, pagesize=(width, height))
-        
-        for i, image_url in enumerate(images):
-            logger.info(f"Processing image {i+1}/{len(images)}")
+        with fitz.open() as doc:
+            page_size = None
             
-            try:
-                image, image_data = download_image(image_url)
+            for i, result in enumerate(download_images(images)):
+                logger.info(f"Processing image {i+1}/{len(images)}")
                 
-                # Save image to temporary file
-                with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_file:
-                    temp_path = temp_file.name
-                    image.save(temp_path, 'JPEG')
+                try:
+                    if result is None:
+                        raise ValueError("download failed")
+                    image, image_data = result
                     
-                    # Add image to PDF
-                    c.drawImage(temp_path, 0, 0, width=width, height=height)
+                    if page_size is None:
+                        # Size every page after the first downloaded image
+                        page_size = image.size
                     
-                    # Schedule cleanup
-                    schedule_cleanup('file', path=temp_path)
-                
-                if i < len(images) - 1:  # Don't add page after last image
-                    c.showPage()
+                    # Embed original bytes when supported, else re-encode to JPEG
+                    if image.format not in PDF_IMAGE_FORMATS:
+                        image_data = encode_jpeg(image_data)
                     
-            except Exception as e:
-                logger.error(f"Failed to process image {i+1}: {str(e)}")
-                continue
-        
-        c.save()
+                    width, height = page_size
+                    page = doc.new_page(width=width, height=height)
+                    page.insert_image(page.rect, stream=image_data, keep_proportion=False)
+                        
+                except Exception as e:
+                    logger.error(f"Failed to process image {i+1}: {str(e)}")
+                    continue
+            
+            if doc.page_count == 0:
+                raise ValueError("No images could be downloaded")
+            
+            # PyMuPDF writes by path, the open handle sees the same file
+            doc.save(pdf_buffer.name, deflate=True)
         pdf_buffer.seek(0)
         return pdf_buffer
         
@@ -143,52 +324,41 @@ def create_ppt_from_images(images, title):
     try:
         prs = Presentation()
         
-        # Remove default slide layout
-        prs.slide_layouts._sldLayouts.clear()
+        # Blank layout has no placeholders, so slides hold only the image
+        blank_layout = prs.slide_layouts[6]
         
-        for i, image_url in enumerate(images):
+        for i, result in enumerate(download_images(images)):
             logger.info(f"Processing slide {i+1}/{len(images)}")
             
             try:
-                image, image_data = download_image(image_url)
+                if result is None:
+                    raise ValueError("download failed")
+                image, image_data = result
                 width, height = image.size
                 
-                # Create slide with custom size
-                slide_layout = prs.slide_layouts[0] if prs.slide_layouts else None
-                if slide_layout is None:
-                    # Create blank slide
-                    slide = prs.slides.add_slide(prs.slide_layouts[6])  # Blank layout
-                else:
-                    slide = prs.slides.add_slide(slide_layout)
+                slide = prs.slides.add_slide(blank_layout)
                 
-                # Clear existing shapes
-                for shape in slide.shapes:
-                    if hasattr(shape, 'element'):
-                        shape.element.getparent().remove(shape.element)
+                # Embed original bytes when pptx supports the format, else re-encode to JPEG
+                if image.format in PPTX_IMAGE_FORMATS:
+                    picture_stream = io.BytesIO(image_data)
+                else:
+                    picture_stream = io.BytesIO(encode_jpeg(image_data))
                 
-                # Save image to temporary file
-                with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_file:
-                    temp_path = temp_file.name
-                    image.save(temp_path, 'JPEG')
-                    
-                    # Add image to slide (full slide)
-                    slide.shapes.add_picture(
-                        temp_path, 
-                        Inches(0), 
-                        Inches(0),
-                        width=Inches(10),  # Standard slide width
-                        height=Inches(7.5)  # Standard slide height
-                    )
-                    
-                    # Schedule cleanup
-                    schedule_cleanup('file', path=temp_path)
+                # Add image to slide (full slide)
+                slide.shapes.add_picture(
+                    picture_stream, 
+                    Inches(0), 
+                    Inches(0),
+                    width=Inches(10),  # Standard slide width
+                    height=Inches(7.5)  # Standard slide height
+                )
                     
             except Exception as e:
                 logger.error(f"Failed to process slide {i+1}: {str(e)}")
                 continue
         
         # Save to buffer
-        ppt_buffer = io.BytesIO()
+        ppt_buffer = create_output_file()
         prs.save(ppt_buffer)
         ppt_buffer.seek(0)
         return ppt_buffer
@@ -197,39 +367,59 @@ def create_ppt_from_images(images, title):
         logger.error(f"PPT creation failed: {str(e)}")
         raise
 
+def write_zip_entries(zip_file, pending, block_head=False, drain=False):
+    """Write queued (index, filename, bytes or Future, source bytes) entries to ZIP in order"""
+    # Stops at the first entry still encoding; block_head waits on the oldest only, drain on all
+    while pending:
+        i, filename, content, image_data = pending[0]
+        if hasattr(content, 'result'):
+            if not (block_head or drain) and not content.done():
+                return
+            block_head = False
+            try:
+                content = encode_result(content, image_data, ZIP_JPEG_QUALITY)
+            except Exception as e:
+                logger.error(f"Failed to add image {i+1} to ZIP: {str(e)}")
+                pending.popleft()
+                continue
+        zip_file.writestr(filename, content)
+        pending.popleft()
+
 def create_zip_from_images(images, title):
     """Create ZIP file from list of image URLs"""
     try:
-        zip_buffer = io.BytesIO()
+        zip_buffer = create_output_file()
+        pending = deque()
         
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for i, image_url in enumerate(images):
+        # JPEGs are already compressed, so store them without Deflate
+        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as zip_file:
+            for i, result in enumerate(download_images(images)):
                 logger.info(f"Downloading image {i+1}/{len(images)}")
                 
                 try:
-                    image, image_data = download_image(image_url)
+                    if result is None:
+                        raise ValueError("download failed")
+                    image, image_data = result
                     
                     # Save image with proper filename
                     filename = f"slide_{str(i+1).zfill(3)}.jpg"
                     
-                    # Convert to JPEG if needed
-                    if image.mode in ('RGBA', 'LA'):
-                        # Convert RGBA to RGB
-                        rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-                        rgb_image.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-                        image = rgb_image
-                    
-                    # Save to buffer
-                    img_buffer = io.BytesIO()
-                    image.save(img_buffer, 'JPEG', quality=95)
-                    img_buffer.seek(0)
-                    
-                    # Add to ZIP
-                    zip_file.writestr(filename, img_buffer.getvalue())
+                    if image.format == 'JPEG':
+                        # Already JPEG, store the downloaded bytes untouched
+                        pending.append((i, filename, image_data, None))
+                    else:
+                        # Re-encode in a worker process while downloads continue
+                        future = submit_encode(image_data, ZIP_JPEG_QUALITY)
+                        pending.append((i, filename, future, image_data))
                     
                 except Exception as e:
                     logger.error(f"Failed to add image {i+1} to ZIP: {str(e)}")
                     continue
+                
+                # Block on the oldest entry once too many are queued
+                write_zip_entries(zip_file, pending, block_head=len(pending) > DOWNLOAD_QUEUE_DEPTH)
+            
+            write_zip_entries(zip_file, pending, drain=True)
         
         zip_buffer.seek(0)
         return zip_buffer
@@ -256,6 +446,13 @@ def convert():
         if format_type not in ['pdf', 'ppt', 'zip']:
             return jsonify({'error': 'Invalid format. Must be pdf, ppt, or zip'}), 400
         
+        # Fail fast on dead URLs before any download or encode work
+        bad_url = find_bad_image_url(images)
+        if bad_url:
+            url, status, error = bad_url
+            logger.error(f"Image URL check failed for {url}: {error}")
+            return jsonify({'error': f'Bad image URL: {error}', 'url': url}), status
+        
         logger.info(f"Converting {len(images)} images to {format_type}")
         
         # Create appropriate file
@@ -275,14 +472,13 @@ def convert():
             mimetype = 'application/zip'
             filename = f"{title}.zip"
         
-        # Schedule buffer cleanup after response
+        # Release buffer once the response has been sent
         if file_buffer:
-            schedule_cleanup('buffer', buffer=file_buffer)
-            
             @after_this_request
             def cleanup_after_response(response):
                 """Cleanup resources after response is sent"""
                 try:
+                    response.call_on_close(file_buffer.close)
                     # Force garbage collection
                     gc.collect()
                     logger.info(f"Response sent, scheduled cleanup for {filename}")
@@ -290,9 +486,10 @@ def convert():
                     logger.error(f"Post-response cleanup error: {e}")
                 return response
         
-        # Return file
+        # Return file by path so the server can stream it straight from disk
+        file_buffer.flush()
         return send_file(
-            file_buffer,
+            file_buffer.name,
             mimetype=mimetype,
             as_attachment=True,
             download_name=filename
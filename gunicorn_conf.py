@@ -0,0 +1,16 @@
+import os
+
+# Gunicorn configuration for the conversion server
+# Threaded workers let slow image downloads from different requests overlap
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = 'gthread'
+workers = int(os.environ.get('WORKERS', str(os.cpu_count() or 1)))
+threads = int(os.environ.get('THREADS', '8'))
+timeout = int(os.environ.get('TIMEOUT', '120'))
+
+# Max simultaneous client connections per worker, including idle keep-alive ones
+worker_connections = 1000
+
+# Keep client connections open between requests
+keepalive = 75